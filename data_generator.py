@@ -70,10 +70,14 @@ class DataGenerator(keras.utils.Sequence):
 
     shuffle: boolean
       True if the dataset has to be shuffled, False otherwise.
+
+    gauss: ndarray, shape (width, height) or None
+      Gaussian channel shared by all the images (see build_training_set), appended as the last channel of every image.
+      None if the images already contain all their channels.
     """
 
     def __init__(self, path, list_IDs, img_suffix, mask_suffix, batch_size=1, dim=(320, 320), n_channels=5,
-                 n_classes=2, shuffle=True):
+                 n_classes=2, shuffle=True, gauss_path=None):
         """
         Initialization of a DataGenerator object. See documentation of the class for a description of the attributes.
         """
@@ -87,6 +91,7 @@ class DataGenerator(keras.utils.Sequence):
         self.n_channels = n_channels
         self.n_classes = n_classes
         self.shuffle = shuffle
+        self.gauss = cv.resize(np.load(gauss_path), self.dim) if gauss_path else None
 
         self.on_epoch_end()
 
@@ -131,12 +136,21 @@ class DataGenerator(keras.utils.Sequence):
         X = np.empty((self.batch_size, *self.dim, self.n_channels))
         y = np.empty((self.batch_size, *self.dim, 1))
 
+        # the gaussian channel is the same for the whole batch
+        n_im_channels = self.n_channels
+        if self.gauss is not None:
+            n_im_channels -= 1
+            X[..., n_im_channels] = self.gauss
+
         # Generate data
         for i, ID in enumerate(list_IDs_temp):
             # Store sample
             new_im = imread(self.path + ID + self.img_suffix)
             im_resized = cv.resize(new_im, self.dim)
-            X[i, ] = im_resized.copy()
+            if im_resized.dtype == np.uint8:
+                # data sets built by build_training_set are saved in uint8
+                im_resized = im_resized / 255
+            X[i, ..., :n_im_channels] = im_resized
 
             # Store class
             new_mask = imread(self.path + ID + self.mask_suffix)
@@ -130,7 +130,7 @@ im_size = (320, 320)
 
 # load json and create model
 model_dir = './saved_models/segmentation_models/'
-model_id = '2019-04-25_12-19-15/'
+model_id = '2019-04-25_12-19-15/'  # trained with the former HLS preprocessing, see the README
 model = load_model(model_dir, model_id)
 
 results_dir = './results/'
@@ -152,7 +152,8 @@ display_some_results(model=model,
                      threshold=0.3,
                      dim=im_size,
                      display=False,
-                     save=True)
+                     save=True,
+                     gauss_path='./ISIC2018_data/gauss.npy')
 
 # superpose image, ground truth and prediction
 specific_images = ['ISIC_0000031', 'ISIC_0000060', 'ISIC_0000073', 'ISIC_0000074', 'ISIC_0000121', 'ISIC_0000166',
@@ -1,13 +1,19 @@
+import concurrent.futures
 import cv2 as cv
+import functools
+import multiprocessing as mp
 import os
 import numpy as np
-
-from skimage.io import imread, imsave
+import queue
+import threading
+import tifffile
 
 
+@functools.lru_cache(maxsize=8)
 def make_gaussian(size, fwhm=125, center=None):
     """
     Make a square gaussian kernel. The code comes from here: https://gist.github.com/andrewgiessel/4635563.
+    The kernel is cached, so the returned array is read-only.
 
     Usage:
      gauss = make_gaussian(size)
@@ -21,11 +27,11 @@ def make_gaussian(size, fwhm=125, center=None):
       Full-width-half-maximum, which can be thought of as an effective radius.
 
     center: tuple
-      Position of the center of the gaussian, default is at the center of the image.
+      Position of the center of the gaussian, default is at the center of the image. Must be hashable (e.g. a tuple).
 
     Returns
     -------
-    image: ndarray, shape (width, height)
+    image: ndarray, shape (width, height), dtype float32
       An image that contains a 2D Gaussian
     """
 
@@ -38,7 +44,10 @@ def make_gaussian(size, fwhm=125, center=None):
         x0 = center[0]
         y0 = center[1]
 
-    return np.exp(-4 * np.log(2) * ((x - x0) ** 2 + (y - y0) ** 2) / fwhm ** 2)
+    gauss = np.exp(-4 * np.log(2) * ((x - x0) ** 2 + (y - y0) ** 2) / fwhm ** 2).astype(np.float32)
+    gauss.setflags(write=False)
+
+    return gauss
 
 
 def preprocessing_unet(im_id,
@@ -51,8 +60,8 @@ def preprocessing_unet(im_id,
                        desired_size=320):
     """
     From a RGB image, create a 5-channel image that contains :
-        - RGB channels after a histogram equalization has been done on the intensity channel in the HSI space,
-        - the original intensity channel,
+        - RGB channels after a histogram equalization has been done on the luminance channel in the YCrCb space,
+        - the original luminance channel,
         - a 2D gaussian centered on the image.
     Besides, we resize the image following the method indicated by the paper.
 
@@ -95,65 +104,353 @@ def preprocessing_unet(im_id,
       The preprocessed mask associated to im_5ch.
     """
 
-    new_im = imread(img_dir + im_id + img_suffix)
-    if mask_bool:
-        new_mask = imread(mask_dir + im_id + mask_suffix)
+    new_im, new_mask = _read_images(im_id, mask_bool, img_dir, mask_dir, img_suffix, mask_suffix)
+
+    return preprocessing_unet_arrays(new_im, new_mask, largest_dimension, desired_size)
+
+
+def preprocessing_unet_arrays(new_im, new_mask=None, largest_dimension=250, desired_size=320, scratch=None,
+                              as_uint8=False):
+    """
+    Same as preprocessing_unet, but on images already loaded in memory.
+
+    Usage:
+     im, mask = preprocessing_unet_arrays(rgb_im, mask) # if training set
+     im = preprocessing_unet_arrays(rgb_im) # if test set
+
+    Parameters
+    ----------
+    new_im: ndarray, shape (width, height, 3)
+      The original RGB image.
+
+    new_mask: ndarray, shape (width, height)
+      The original ground truth mask, default is None (no mask to process).
+
+    largest_dimension: int
+      The largest dimension of the image before padding.
+
+    desired_size: int
+      Pad the image so it is a square image whose dimensions have the desired size.
+
+    scratch: _Scratch
+      Buffers in which the preprocessing is done, default is None (new buffers are allocated). The returned arrays are
+      views on these buffers, so they are overwritten by the next call that uses the same scratch.
+
+    as_uint8: boolean
+      If True, a 4-channel image in uint8 (values multiplied by 255), without the gaussian channel which is the same
+      for every image, is returned instead of the 5-channel image in float32, e.g. to save it on disk. Default is
+      False.
+
+    Returns
+    -------
+    im_5ch: ndarray, shape (width, height, channels)
+      The preprocessed image.
+
+    new_mask: ndarray, shape (width, height) if a mask is given
+      The preprocessed mask associated to im_5ch.
+    """
+
+    mask_bool = new_mask is not None
+    if scratch is None:
+        scratch = _Scratch(desired_size)
 
     # resize so that the largest dimension is 250
     rows, columns, _ = new_im.shape
 
     if rows >= columns:
         percent = largest_dimension / float(rows)
-        csize = int((float(columns) * float(percent)))
-        new_im = cv.resize(new_im, (csize, largest_dimension))
-        if mask_bool:
-            new_mask = cv.resize(new_mask, (csize, largest_dimension))
-
+        rsize, csize = largest_dimension, int((float(columns) * float(percent)))
     else:
         percent = largest_dimension / float(columns)
-        rsize = int((float(rows) * float(percent)))
-        new_im = cv.resize(new_im, (largest_dimension, rsize))
-        if mask_bool:
-            new_mask = cv.resize(new_mask, (largest_dimension, rsize))
+        rsize, csize = int((float(rows) * float(percent))), largest_dimension
+
+    delta_w = desired_size - csize
+    delta_h = desired_size - rsize
+    top, left = delta_h // 2, delta_w // 2
+
+    # resize (area interpolation for the image to avoid aliasing, nearest neighbour to keep the mask binary) directly
+    # into the padded images
+    scratch.padded_rgb.fill(255)
+    scratch.padded_rgb[top:top + rsize, left:left + csize] = cv.resize(new_im, (csize, rsize),
+                                                                       interpolation=cv.INTER_AREA)
+
+    if mask_bool:
+        scratch.padded_mask.fill(0)
+        scratch.padded_mask[top:top + rsize, left:left + csize] = cv.resize(new_mask, (csize, rsize),
+                                                                            interpolation=cv.INTER_NEAREST)
+        new_mask = scratch.padded_mask
+
+    # convert RGB image to YCrCb image (linear, cheaper than HLS), the white padding has a luminance of 255
+    im_ycc = cv.cvtColor(scratch.padded_rgb, cv.COLOR_RGB2YCrCb, dst=scratch.ycc)
+
+    # split the channels so the luminance is a contiguous plane
+    luminance, cr, cb = cv.split(im_ycc, mv=scratch.ycc_planes)
+
+    # original intensity channel (copied before the equalization)
+    original_intensity = scratch.padded_i
+    np.copyto(original_intensity, luminance)
+
+    # histogram equalization on the luminance of the lesion only (not the padding) then convert back to RGB
+    lesion = luminance[top:top + rsize, left:left + csize]
+    cv.equalizeHist(lesion, dst=lesion)
+    cv.merge((luminance, cr, cb), dst=im_ycc)
+    new_im = cv.cvtColor(im_ycc, cv.COLOR_YCrCb2RGB, dst=scratch.padded_rgb)
+
+    # concatenation of the different channels, in uint8 without the gaussian or directly in float32 with the 2D
+    # gaussian
+    if as_uint8:
+        im_5ch = scratch.out4_u8
+        im_5ch[..., :3] = new_im
+        im_5ch[..., 3] = original_intensity
+    else:
+        im_5ch = scratch.out5
+        np.multiply(new_im, np.float32(1 / 255), out=im_5ch[..., :3], casting='unsafe')
+        np.multiply(original_intensity, np.float32(1 / 255), out=im_5ch[..., 3], casting='unsafe')
+        im_5ch[..., 4] = make_gaussian(desired_size)
 
-    # convert RGB image to HSI image
-    im_hsi = cv.cvtColor(new_im, cv.COLOR_RGB2HLS)
+    if mask_bool:
+        return im_5ch, new_mask
+    else:
+        return im_5ch
 
-    # original intensity channel
-    original_intensity = im_hsi[:, :, 1]
 
-    delta_w = desired_size - new_im.shape[1]
-    delta_h = desired_size - new_im.shape[0]
-    top, bottom = delta_h // 2, delta_h - (delta_h // 2)
-    left, right = delta_w // 2, delta_w - (delta_w // 2)
+class _Scratch:
+    """
+    Buffers reused by preprocessing_unet_arrays from one image to the next, to avoid allocating them for every image.
 
-    # we pad this image
-    original_intensity = cv.copyMakeBorder(original_intensity, top, bottom, left, right, cv.BORDER_CONSTANT,
-                                           value=[255])
-    original_intensity = np.expand_dims(original_intensity, axis=2)
+    Attributes
+    ----------
+    padded_rgb: ndarray, shape (desired_size, desired_size, 3)
+      The padded RGB image.
 
-    # histogram equalization on the intensity channel then convert back to RGB
-    im_hsi[:, :, 1] = cv.equalizeHist(im_hsi[:, :, 1])
-    new_im = cv.cvtColor(im_hsi, cv.COLOR_HLS2RGB)
+    padded_mask: ndarray, shape (desired_size, desired_size)
+      The padded mask.
 
-    # we pad the image
-    new_im = cv.copyMakeBorder(new_im, top, bottom, left, right, cv.BORDER_CONSTANT, value=[255, 255, 255])
+    ycc: ndarray, shape (desired_size, desired_size, 3)
+      The padded image in the YCrCb space.
 
-    if mask_bool:
-        # we also pad the mask
-        new_mask = cv.copyMakeBorder(new_mask, top, bottom, left, right, cv.BORDER_CONSTANT, value=[0])
+    ycc_planes: list of ndarrays, shape (desired_size, desired_size)
+      The Y, Cr and Cb planes of ycc.
 
-    # 2D gaussian
-    gauss = make_gaussian(desired_size)
-    gauss = np.expand_dims(gauss, axis=2)
+    padded_i: ndarray, shape (desired_size, desired_size)
+      The original luminance channel.
 
-    # concatenation of the different channels
-    im_5ch = np.concatenate((new_im / 255, original_intensity / 255, gauss), axis=2)
+    out5: ndarray, shape (desired_size, desired_size, 5)
+      The 5-channel image.
+
+    out4_u8: ndarray, shape (desired_size, desired_size, 4)
+      The image without the gaussian channel quantized to uint8.
+    """
+
+    def __init__(self, desired_size):
+        """
+        Initialization of a _Scratch object. See documentation of the class for a description of the attributes.
+        """
+
+        self.padded_rgb = np.empty((desired_size, desired_size, 3), dtype=np.uint8)
+        self.padded_mask = np.empty((desired_size, desired_size), dtype=np.uint8)
+        self.ycc = np.empty((desired_size, desired_size, 3), dtype=np.uint8)
+        self.ycc_planes = [np.empty((desired_size, desired_size), dtype=np.uint8) for _ in range(3)]
+        self.padded_i = np.empty((desired_size, desired_size), dtype=np.uint8)
+        self.out5 = np.empty((desired_size, desired_size, 5), dtype=np.float32)
+        self.out4_u8 = np.empty((desired_size, desired_size, 4), dtype=np.uint8)
+
+
+def _imread(path, flags):
+    """
+    Same as cv.imread, but raise a FileNotFoundError if the image cannot be read (cv.imread returns None).
+    """
+
+    im = cv.imread(path, flags)
+    if im is None:
+        raise FileNotFoundError('Cannot read the image ' + path)
+
+    return im
+
+
+def _imwrite(path, im):
+    """
+    Same as cv.imwrite, but raise an IOError if the image cannot be written (cv.imwrite returns False).
+    """
+
+    if not cv.imwrite(path, im):
+        raise IOError('Cannot write the image ' + path)
+
+
+def _read_images(im_id, mask_bool, img_dir, mask_dir, img_suffix, mask_suffix):
+    """
+    Read an image (converted to RGB) and, if mask_bool is True, its mask. The mask is None otherwise.
+    """
+
+    new_im = cv.cvtColor(_imread(img_dir + im_id + img_suffix, cv.IMREAD_COLOR), cv.COLOR_BGR2RGB)
+    new_mask = _imread(mask_dir + im_id + mask_suffix, cv.IMREAD_GRAYSCALE) if mask_bool else None
+
+    return new_im, new_mask
 
-    if mask_bool:
-        return im_5ch, new_mask
-    else:
-        return im_5ch
+
+def _load_images(items, q, img_dir, mask_dir, img_suffix, mask_suffix):
+    """
+    Read the images and masks of a list of (id, split) items and put them in a queue, in order to decode the next
+    images while the current one is preprocessed. If an error occurs, it is put in the queue and the loading stops.
+    """
+
+    try:
+        for im_id, split in items:
+            q.put((im_id, split, *_read_images(im_id, True, img_dir, mask_dir, img_suffix, mask_suffix)))
+    except Exception as e:
+        q.put(e)
+
+
+def _flip_image(im, flip_code):
+    """
+    Flip a 4 or 5-channel image like cv.flip, except for the gaussian channel (if any) which is centered and therefore
+    shared by all the augmentations.
+
+    Parameters
+    ----------
+    im: ndarray, shape (width, height, channels)
+      Image returned by preprocessing_unet.
+
+    flip_code: int
+      0 to flip around the x-axis, 1 to flip around the y-axis and -1 to flip around both axes (as in cv.flip).
+
+    Returns
+    -------
+    flipped_im: ndarray, shape (width, height, channels)
+      The flipped image.
+    """
+
+    rows = slice(None, None, -1) if flip_code <= 0 else slice(None)
+    columns = slice(None, None, -1) if flip_code != 0 else slice(None)
+
+    flipped_im = np.empty_like(im)
+    flipped_im[..., :4] = im[rows, columns, :4]
+    flipped_im[..., 4:] = im[..., 4:]
+
+    return flipped_im
+
+
+# thread pool and buffers used by each worker process; there are two sets of buffers so that an image can be
+# preprocessed while the previous one is being written
+_io_pool = None
+_scratches = None
+
+
+def _init_worker(desired_size):
+    """
+    Initialize a worker process of build_training_set. OpenCV only uses one thread in each worker, otherwise every
+    worker would spawn as many threads as there are cores.
+    """
+
+    global _io_pool, _scratches
+
+    cv.setNumThreads(0)
+    _io_pool = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+    _scratches = [_Scratch(desired_size), _Scratch(desired_size)]
+
+
+def _wait_writes(futures):
+    """
+    Wait for the writes submitted to the thread pool of the worker, and raise their errors if any.
+    """
+
+    for future in concurrent.futures.as_completed(futures):
+        future.result()
+
+
+def _process_one(im_id, split, im_raw, mask_raw, output_path, mask_suffix, largest_dimension, desired_size, scratch):
+    """
+    Preprocess one image and save it in the data set, with its augmentations if it belongs to the training set. The
+    images are written in the background by the thread pool of the worker.
+
+    Parameters
+    ----------
+    im_id: string
+      Id of the image.
+
+    split: string
+      Either 'train' or 'test'.
+
+    im_raw: ndarray, shape (width, height, 3)
+      The original RGB image.
+
+    mask_raw: ndarray, shape (width, height)
+      The original mask.
+
+    scratch: _Scratch
+      Buffers used for the preprocessing, they must not be reused before the returned writes are over.
+
+    See build_training_set for the other parameters.
+
+    Returns
+    -------
+    futures: list of Futures
+      The writes of the images.
+    """
+
+    # the images are saved in uint8 and without the gaussian (saved once in gauss.npy), the DataGenerator scales them
+    # back to [0, 1] and adds the gaussian
+    im, mask = preprocessing_unet_arrays(im_raw, mask_raw, largest_dimension, desired_size, scratch, as_uint8=True)
+
+    futures = [_io_pool.submit(tifffile.imwrite, output_path + split + '/' + im_id + '.tiff', im, compression='zlib'),
+               _io_pool.submit(_imwrite, output_path + split + '/' + im_id + mask_suffix, mask)]
+
+    if split == 'train':
+        hflip_im, hflip_mask = _flip_image(im, 0), cv.flip(mask, 0)
+        vflip_im, vflip_mask = _flip_image(im, 1), cv.flip(mask, 1)
+        rot_im, rot_mask = _flip_image(im, -1), cv.flip(mask, -1)
+
+        futures += [
+            _io_pool.submit(tifffile.imwrite, output_path + 'train/' + 'hflip_' + im_id + '.tiff', hflip_im,
+                            compression='zlib'),
+            _io_pool.submit(_imwrite, output_path + 'train/' + 'hflip_' + im_id + mask_suffix, hflip_mask),
+            _io_pool.submit(tifffile.imwrite, output_path + 'train/' + 'vflip_' + im_id + '.tiff', vflip_im,
+                            compression='zlib'),
+            _io_pool.submit(_imwrite, output_path + 'train/' + 'vflip_' + im_id + mask_suffix, vflip_mask),
+            _io_pool.submit(tifffile.imwrite, output_path + 'train/' + 'rot_' + im_id + '.tiff', rot_im,
+                            compression='zlib'),
+            _io_pool.submit(_imwrite, output_path + 'train/' + 'rot_' + im_id + mask_suffix, rot_mask)
+        ]
+
+    return futures
+
+
+def _process_ids(args):
+    """
+    Preprocess and save a list of images. The images are read by a separate thread a few ids ahead, and the writes of
+    an image overlap with the preprocessing of the next one.
+
+    Parameters
+    ----------
+    args: tuple
+      (items, output_path, img_dir, mask_dir, img_suffix, mask_suffix, largest_dimension, desired_size), where items is
+      a list of (id, split) and split is either 'train' or 'test'.
+    """
+
+    items, output_path, img_dir, mask_dir, img_suffix, mask_suffix, largest_dimension, desired_size = args
+
+    q = queue.Queue(maxsize=8)
+    threading.Thread(target=_load_images, args=(items, q, img_dir, mask_dir, img_suffix, mask_suffix),
+                     daemon=True).start()
+
+    # writes of the last image preprocessed with each scratch
+    pending = [[], []]
+    for k in range(len(items)):
+        item = q.get()
+        if isinstance(item, Exception):
+            raise item
+
+        # the scratches are used alternately: the buffers of a scratch are only reused once the image previously
+        # preprocessed in it is written
+        _wait_writes(pending[k % 2])
+
+        im_id, split, im_raw, mask_raw = item
+        pending[k % 2] = _process_one(im_id, split, im_raw, mask_raw, output_path, mask_suffix, largest_dimension,
+                                      desired_size, _scratches[k % 2])
+
+    # everything must be on disk before the worker moves on to the next task (it may be the last one)
+    for futures in pending:
+        _wait_writes(futures)
 
 
 # the data set is available here:
@@ -173,10 +470,13 @@ def build_training_set(output_path='./ISIC2018_data/',
                        seed=42):
     """
     Build the preprocessed data set from the ISIC data set. The preprocessing applies the method indicated in the paper.
+    The images are saved with 4 channels in uint8; the gaussian channel, which is the same for every image, is saved
+    once in output_path + 'gauss.npy'.
 
     Usage:
       Download and unzip the ISIC data set (https://challenge2018.isic-archive.com/task1/training/)
-      build_training_set()
+      if __name__ == '__main__':  # required by the pool of workers (e.g. on Windows and macOS)
+          build_training_set()
 
     Parameters
     ----------
@@ -219,23 +519,15 @@ def build_training_set(output_path='./ISIC2018_data/',
     if os.path.isdir(output_path + 'test') == 0:
         os.mkdir(output_path + 'test')
 
-    # names of the images
-    list_ids = os.listdir(img_dir)
-
-    # remove the .txt files
-    if 'LICENSE.txt' in list_ids:
-        list_ids.remove('LICENSE.txt')
-    if 'ATTRIBUTION.txt' in list_ids:
-        list_ids.remove('ATTRIBUTION.txt')
-
-    # only keep the ids
-    for k in range(len(list_ids)):
-        list_ids[k] = list_ids[k].replace(img_suffix, '')
+    # ids of the images (the other files, e.g. LICENSE.txt and ATTRIBUTION.txt, are ignored)
+    with os.scandir(img_dir) as it:
+        list_ids = [e.name[:len(e.name) - len(img_suffix)] for e in it if e.is_file() and e.name.endswith(img_suffix)]
 
     n = len(list_ids)
 
     # split our data set
-    indices = np.random.RandomState(seed=seed).permutation(n)
+    rng = np.random.RandomState(seed=seed)
+    indices = rng.permutation(n)
     train_idx, validation_idx = indices[:int(train_ratio * n)], indices[int(train_ratio * n):]
 
     partition = {'train': np.array(list_ids)[train_idx],
@@ -244,37 +536,25 @@ def build_training_set(output_path='./ISIC2018_data/',
 
     # check that the ids we want to test are in the test set
     if specific_ids:
-        for k in range(len(partition['train'])):
-            for id_ in specific_ids:
-                if id_ == partition['train'][k]:
-                    rd_idx = np.random.randint(len(partition['test']))
-                    partition['train'][k] = partition['test'][rd_idx]
-                    partition['test'][rd_idx] = id_
-
-    # create the training set
-    for k in range(len(partition['train'])):
-        im_path = partition['train'][k]
-        im, mask = preprocessing_unet(im_path, True, img_dir, mask_dir, img_suffix, mask_suffix, largest_dimension,
-                                      desired_size)
-
-        hflip_im, hflip_mask = cv.flip(im, 0), cv.flip(mask, 0)
-        vflip_im, vflip_mask = cv.flip(im, 1), cv.flip(mask, 1)
-        rot_im, rot_mask = cv.flip(im, -1), cv.flip(mask, -1)
-
-        imsave(output_path + 'train/' + partition['train'][k] + '.tiff', im)
-        imsave(output_path + 'train/' + partition['train'][k] + mask_suffix, mask)
-        imsave(output_path + 'train/' + 'hflip_' + partition['train'][k] + '.tiff', hflip_im)
-        imsave(output_path + 'train/' + 'hflip_' + partition['train'][k] + mask_suffix, hflip_mask)
-        imsave(output_path + 'train/' + 'vflip_' + partition['train'][k] + '.tiff', vflip_im)
-        imsave(output_path + 'train/' + 'vflip_' + partition['train'][k] + mask_suffix, vflip_mask)
-        imsave(output_path + 'train/' + 'rot_' + partition['train'][k] + '.tiff', rot_im)
-        imsave(output_path + 'train/' + 'rot_' + partition['train'][k] + mask_suffix, rot_mask)
-
-    # create the test set
-    for k in range(len(partition['test'])):
-        im_path = partition['test'][k]
-        im, mask = preprocessing_unet(im_path, True, img_dir, mask_dir, img_suffix, mask_suffix, largest_dimension,
-                                      desired_size)
-
-        imsave(output_path + 'test/' + partition['test'][k] + '.tiff', im)
-        imsave(output_path + 'test/' + partition['test'][k] + mask_suffix, mask)
+        offenders = np.where(np.isin(partition['train'], specific_ids))[0]
+        # swap them with random ids from the test set which are not in specific_ids
+        candidates = np.where(~np.isin(partition['test'], specific_ids))[0]
+        swap_targets = rng.choice(candidates, size=len(offenders), replace=False)
+        partition['train'][offenders], partition['test'][swap_targets] = \
+            partition['test'][swap_targets].copy(), partition['train'][offenders].copy()
+
+    # each id is processed independently, so the training and test sets are built together by a pool of workers; the
+    # ids are shuffled to balance the work (the training ids have augmentations) and dispatched by chunks (the images
+    # of a chunk are prefetched by the worker)
+    all_items = [(im_id, 'train') for im_id in partition['train']] + [(im_id, 'test') for im_id in partition['test']]
+    rng.shuffle(all_items)
+
+    chunk = 16
+    args = [(all_items[k:k + chunk], output_path, img_dir, mask_dir, img_suffix, mask_suffix, largest_dimension,
+             desired_size) for k in range(0, len(all_items), chunk)]
+
+    with mp.Pool(os.cpu_count(), initializer=_init_worker, initargs=(desired_size,)) as p:
+        list(p.imap_unordered(_process_ids, args))
+
+    # the gaussian channel, shared by all the images
+    np.save(output_path + 'gauss.npy', make_gaussian(desired_size))
@@ -51,6 +51,7 @@ infos = {'loss': loss,
 # data sets and generators
 train_data_path = './ISIC2018_data/train/'
 test_data_path = './ISIC2018_data/test/'
+params['gauss_path'] = './ISIC2018_data/gauss.npy'  # gaussian channel shared by all the images
 
 IDs_train = retrieve_ids(train_data_path, params['img_suffix'], params['mask_suffix'])
 IDs_test = retrieve_ids(test_data_path, params['img_suffix'], params['mask_suffix'])
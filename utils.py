@@ -173,7 +173,7 @@ def save_history_figure(history, path):
 
 
 def display_some_results(model, im_names, im_path, im_suffix, mask_suffix, threshold=0.3, dim=(320, 320), display=True,
-                         save=False):
+                         save=False, gauss_path=None):
     """
     Compute predictions with a model and display and/or save them.
 
@@ -206,6 +206,10 @@ def display_some_results(model, im_names, im_path, im_suffix, mask_suffix, thres
     save: boolean
       States if images will be saved. Default is True.
 
+    gauss_path: string
+      Path to the gaussian channel saved by build_training_set, appended to the images. Default is None (the images
+      already contain all their channels).
+
     Returns
     -------
     predictions: list of ndarrays, shape (width, height)
@@ -223,6 +227,7 @@ def display_some_results(model, im_names, im_path, im_suffix, mask_suffix, thres
     ax = []
     predictions = []
     bin_predictions = []    
+    gauss = np.expand_dims(cv2.resize(np.load(gauss_path), dim), axis=2) if gauss_path else None
     
     if save:
         # date
@@ -249,7 +254,13 @@ def display_some_results(model, im_names, im_path, im_suffix, mask_suffix, thres
         ground_truth = imread(data_path + im_id + mask_suffix)
 
         # grayscale prediction
-        prediction = model.predict(np.expand_dims(cv2.resize(image_test, dim), axis=0))
+        net_input = cv2.resize(image_test, dim)
+        if net_input.dtype == np.uint8:
+            # data sets built by build_training_set are saved in uint8
+            net_input = net_input / 255
+        if gauss is not None:
+            net_input = np.concatenate((net_input, gauss), axis=2)
+        prediction = model.predict(np.expand_dims(net_input, axis=0))
         grayscale_pred = np.squeeze(prediction)
         predictions.append(grayscale_pred)
 